@@ -1,7 +1,5 @@
 
 from shlex import shlex
-import shutil
-import numpy as np
 import pathlib
 import importlib.resources
 
@@ -24,12 +22,12 @@ def get_validation_setup(config_dir=None, setup_file='validationSetup.txt'):
             validationSetup = _readValidationSetupFile(f)
     else:
         # fall back on default config included with package
-        with importlib.resources.open_text(__package__, setup_file) as f:
+        with (importlib.resources.files(__package__)/setup_file).open() as f:
             validationSetup = _readValidationSetupFile(f)
 
     # parse numerics into int or float
     for key,val in validationSetup.items():
-        if np.all([c.isdigit() for c in val]):
+        if val.isdigit():
             validationSetup[key] = int(val)
         else:
             try:
@@ -39,6 +37,17 @@ def get_validation_setup(config_dir=None, setup_file='validationSetup.txt'):
     return validationSetup
 
 
+def get_aruco_detector_params(validationSetup):
+    params = {'markerBorderBits': validationSetup['markerBorderBits']}
+    # ArUco3 detection first looks for markers in a downscaled image, which is several times faster.
+    # It can miss some markers, so is off for configurations that predate this setting
+    if validationSetup.get('useAruco3Detection', 0):
+        params['useAruco3Detection']              = True
+        params['minSideLengthCanonicalImg']       = 16
+        params['minMarkerLengthRatioOriginalImg'] = 0.008
+    return params
+
+
 def _read_coord_file(config_dir, file):
     if config_dir is not None:
         return data_files.read_coord_file(config_dir / file)
@@ -58,9 +67,9 @@ def deploy_validation_config(output_dir):
         raise RuntimeError('the requested directory "%s" does not exist' % output_dir)
 
     # copy over all config files
+    resources = importlib.resources.files(__package__)
     for r in ['markerPositions.csv', 'targetPositions.csv', 'validationSetup.txt']:
-        with importlib.resources.path(__package__, r) as p:
-            shutil.copyfile(p, str(output_dir/r))
+        (output_dir/r).write_bytes((resources/r).read_bytes())
 
     # copy over poster tex file
     poster_dir = output_dir / 'poster'
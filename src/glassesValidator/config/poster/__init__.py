@@ -3,7 +3,6 @@ import numpy as np
 import pandas as pd
 import pathlib
 import importlib.resources
-import shutil
 import math
 from matplotlib import colors
 
@@ -15,9 +14,9 @@ def deploy_maker(output_dir):
         raise RuntimeError('the requested directory "%s" does not exist' % output_dir)
 
     # copy over all files
+    resources = importlib.resources.files(__package__)
     for r in ['poster.tex']:
-        with importlib.resources.path(__package__, r) as p:
-            shutil.copyfile(p, str(output_dir/r))
+        (output_dir/r).write_bytes((resources/r).read_bytes())
 
     deploy_marker_images(output_dir)
 
@@ -39,8 +38,7 @@ def deploy_default_pdf(output_file_or_dir):
     if output_file_or_dir.is_dir():
         output_file_or_dir = output_file_or_dir / 'poster.pdf'
 
-    with importlib.resources.path(__package__,'poster.pdf') as p:
-        shutil.copyfile(p, str(output_file_or_dir))
+    output_file_or_dir.write_bytes((importlib.resources.files(__package__)/'poster.pdf').read_bytes())
 
 
 class Poster(plane.Plane):
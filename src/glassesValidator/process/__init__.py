@@ -124,7 +124,12 @@ def collect_data_quality(rec_dirs: list[str | pathlib.Path], file_name: str|dict
         rec_files = [f for f in rec_files if f[0].is_file()]
     if not rec_files:
         return None, None, None
-    df = pd.concat((pd.read_csv(rec[0], delimiter='\t').assign(**rec[1]) for rec in rec_files), ignore_index=True)
+    dfs = []
+    for f_path,cols in rec_files:
+        dfs.append(pd.read_csv(f_path, delimiter='\t'))
+        for c in cols:
+            dfs[-1][c] = cols[c]
+    df = pd.concat(dfs, ignore_index=True)
     if df.empty:
         return None, None, None
     # set indices
@@ -149,17 +154,10 @@ def collect_data_quality(rec_dirs: list[str | pathlib.Path], file_name: str|dict
     return df, default_dq_type, targets
 
 def summarize_and_store_data_quality(df: pd.DataFrame, output_file_or_dir: str | pathlib.Path, dq_types: list[DataQualityType], targets: list[int], average_over_targets = False, include_data_loss = False):
-    dq_types_have = sorted(list(df.index.levels[df.index.names.index('type')]), key=lambda dq: dq.value)
-    targets_have  = list(df.index.levels[df.index.names.index('target')])
-
-    # remove unwanted types of data quality
-    dq_types_sel = [dq in dq_types for dq in dq_types_have]
-    if not all(dq_types_sel):
-        df = df.drop(index=[dq for i,dq in enumerate(dq_types_have) if not dq_types_sel[i]], level='type')
-    # remove unwanted targets
-    targets_sel = [t in targets for t in targets_have]
-    if not all(targets_sel):
-        df = df.drop(index=[t for i,t in enumerate(targets_have) if not targets_sel[i]], level='target')
+    # remove unwanted types of data quality and unwanted targets
+    qKeep = df.index.get_level_values('type').isin(dq_types) & df.index.get_level_values('target').isin(targets)
+    if not qKeep.all():
+        df = df[qKeep]
     # remove unwanted data loss
     if not include_data_loss and 'data_loss' in df.columns:
         df = df.drop(columns='data_loss')
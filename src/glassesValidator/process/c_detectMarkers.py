@@ -55,7 +55,7 @@ def do_the_work(working_dir, config_dir, gui, show_rejected_markers):
     # set up pose estimator and run it
     estimator = aruco.PoseEstimator(in_video, working_dir / naming.frame_timestamps_fname, working_dir / naming.scene_camera_calibration_fname)
     estimator.add_plane('validate',
-                        {'plane': poster, 'aruco_params': {'markerBorderBits': validationSetup['markerBorderBits']}, 'min_num_markers': validationSetup['minNumMarkers']},
+                        {'plane': poster, 'aruco_params': config.get_aruco_detector_params(validationSetup), 'min_num_markers': validationSetup['minNumMarkers']},
                         analyzeFrames)
     estimator.attach_gui(gui, {annotation.Event.Validate: [i for iv in analyzeFrames for i in iv]})
     if gui is not None:
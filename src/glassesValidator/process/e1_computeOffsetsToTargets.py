@@ -1,12 +1,10 @@
 import pathlib
-import math
 
 import numpy as np
 import pandas as pd
 import polars as pl
 
-from glassesTools import gaze_worldref, plane, transforms
-from glassesTools import utils as gt_utils
+from glassesTools import gaze_worldref, plane
 
 from .. import config
 from .. import utils
@@ -42,115 +40,153 @@ def process(working_dir: str|pathlib.Path, config_dir: str|pathlib.Path=None,
 
     # get info about markers on our poster
     poster          = config.poster.Poster(config_dir, validationSetup)
-    targets         = {ID: np.append(poster.targets[ID].center,  0.  ) for ID in poster.targets}   # get centers of targets
+    targets         = np.array(list(poster.targets))
+    targets_h       = np.array([np.append(poster.targets[ID].center, [0., 1.]) for ID in targets])     # get centers of targets, homogeneous coordinates
     distMm          = validationSetup['distance']*10.
-    targets_for_homo= {ID: np.append(poster.targets[ID].center,distMm) for ID in poster.targets}   # get centers of targets
+    targets_for_homo= np.array([np.append(poster.targets[ID].center, distMm  ) for ID in targets])     # get centers of targets
 
     # get types of data quality to compute
     dq_types = [DataQualityType.viewpos_vidpos_homography,DataQualityType.pose_vidpos_homography,DataQualityType.pose_vidpos_ray,DataQualityType.pose_world_eye,DataQualityType.pose_left_eye,DataQualityType.pose_right_eye]
 
+    # collect gaze data into arrays once, so that each interval is a simple selection
+    gazeFrameIdxs, gazes = utils.gaze_dict_to_arrays(gazesPoster, ['timestamp',
+        'gazeOriCamLeft','gazeOriCamRight','gazePosCamLeft','gazePosCamRight','gazePosPlane2DLeft','gazePosPlane2DRight',
+        'gazePosCamWorld','gazePosPlane2DWorld','gazePosCam_vidPos_ray','gazePosPlane2D_vidPos_ray','gazePosCam_vidPos_homography','gazePosPlane2D_vidPos_homography'])
+
+    # get camera pose w.r.t. poster for each frame spanned by the gaze data, so it can be directly
+    # looked up for each sample. Frames without (a complete) pose get a NaN pose
+    frameOff     = gazeFrameIdxs[0] if gazeFrameIdxs.size else 0
+    nFrame       = gazeFrameIdxs[-1]-frameOff+1 if gazeFrameIdxs.size else 0
+    frames       = np.array([f for f in poses if f>=frameOff and f-frameOff<nFrame], dtype='int')
+    frameHasPose = np.zeros(nFrame, dtype='bool')
+    frameHasPose[frames-frameOff] = True
+    frames       = np.array([f for f in frames if poses[f].pose_R_vec is not None and poses[f].pose_T_vec is not None], dtype='int')
+    frameRt      = np.full((nFrame,3,4), np.nan)
+    if frames.size:
+        frameRt[frames-frameOff] = np.concatenate((_rodrigues(np.stack([poses[f].pose_R_vec.flatten() for f in frames])),
+                                                   np.stack([poses[f].pose_T_vec.reshape(3,1) for f in frames])), axis=2)
+
     # for each frame during analysis interval, determine offset
     # (angle) of gaze (each eye) to each of the targets
     dfs = []
     for idx,iv in enumerate(analyzeFrames):
-        gazesPosterToAnal= {k:v for (k,v) in gazesPoster.items() if k>=iv[0] and k<=iv[1]}
-        if not gazesPosterToAnal:
+        sel = slice(np.searchsorted(gazeFrameIdxs, iv[0]), np.searchsorted(gazeFrameIdxs, iv[1], side='right'))
+        if sel.start==sel.stop:
             raise RuntimeError(f'There is no gaze data on the poster for validation interval (frames {iv[0]} to {iv[1]}), cannot proceed. This may be because there was no gaze during this interval or because the poster was not detected.')
 
-        frameIdxs        =           [k                                     for k,v in gazesPosterToAnal.items()  for s in v]
-        ts               = np.vstack([s.timestamp                           for v in gazesPosterToAnal.values() for s in v])
-        oriLeft          = np.vstack([s.gazeOriCamLeft                      for v in gazesPosterToAnal.values() for s in v])
-        oriRight         = np.vstack([s.gazeOriCamRight                     for v in gazesPosterToAnal.values() for s in v])
-        gaze3DLeft       = np.vstack([s.gazePosCamLeft                      for v in gazesPosterToAnal.values() for s in v])
-        gaze3DRight      = np.vstack([s.gazePosCamRight                     for v in gazesPosterToAnal.values() for s in v])
-        gaze2DLeft       = np.vstack([s.gazePosPlane2DLeft                  for v in gazesPosterToAnal.values() for s in v])
-        gaze2DRight      = np.vstack([s.gazePosPlane2DRight                 for v in gazesPosterToAnal.values() for s in v])
-        gaze3DWorld      = np.vstack([s.gazePosCamWorld                     for v in gazesPosterToAnal.values() for s in v])
-        gaze2DWorld      = np.vstack([s.gazePosPlane2DWorld                 for v in gazesPosterToAnal.values() for s in v])
-        gaze3DRay        = np.vstack([s.gazePosCam_vidPos_ray               for v in gazesPosterToAnal.values() for s in v])
-        gaze2DRay        = np.vstack([s.gazePosPlane2D_vidPos_ray           for v in gazesPosterToAnal.values() for s in v])
-        gaze3DHomography = np.vstack([s.gazePosCam_vidPos_homography        for v in gazesPosterToAnal.values() for s in v])
-        gaze2DHomography = np.vstack([s.gazePosPlane2D_vidPos_homography    for v in gazesPosterToAnal.values() for s in v])
-
-        offset = np.empty((oriLeft.shape[0],len(dq_types),len(targets),2))
-        offset[:] = np.nan
-
-        for s in range(oriLeft.shape[0]):
-            if frameIdxs[s] not in poses:
-                continue
-
-            # all based on pose info
-            targets_cam: dict[int,np.ndarray] = {}
-            for e in range(len(dq_types)):
-                match dq_types[e]:
-                    case DataQualityType.viewpos_vidpos_homography | DataQualityType.pose_vidpos_homography:
-                        # from camera perspective, using homography
-                        # pose_vidpos_homography   : using pose info
-                        # viewpos_vidpos_homography: using assumed viewing distance
-                        ori         = np.zeros(3)
-                        gaze        = gaze3DHomography[s,:]
-                        gazePoster  = gaze2DHomography[s,:]
-                    case DataQualityType.pose_vidpos_ray:
-                        # from camera perspective, using 3D gaze point ray
-                        ori         = np.zeros(3)
-                        gaze        = gaze3DRay[s,:]
-                        gazePoster  = gaze2DRay[s,:]
-                    case DataQualityType.pose_world_eye:
-                        # using 3D world gaze position, with respect to eye tracker reference frame's origin
-                        ori         = np.zeros(3)
-                        gaze        = gaze3DWorld[s,:]
-                        gazePoster  = gaze2DWorld[s,:]
-                    case DataQualityType.pose_left_eye:
-                        ori         = oriLeft[s,:]
-                        gaze        = gaze3DLeft[s,:]
-                        gazePoster  = gaze2DLeft[s,:]
-                    case DataQualityType.pose_right_eye:
-                        ori         = oriRight[s,:]
-                        gaze        = gaze3DRight[s,:]
-                        gazePoster  = gaze2DRight[s,:]
-
-                if np.any(np.isnan(ori)) or np.any(np.isnan(gazePoster)) or (dq_types[e]!=DataQualityType.viewpos_vidpos_homography and np.any(np.isnan(gaze))):
-                    continue
-
-                for ti,t in enumerate(targets):
-                    if dq_types[e]==DataQualityType.viewpos_vidpos_homography:
-                        # get vectors based on assumed viewing distance (from config), without using pose info
-                        vGaze   = np.array([gazePoster[0], gazePoster[1], distMm])
-                        vTarget = targets_for_homo[t]
-                    else:
-                        # use 3D vectors known given pose information
-                        if t not in targets_cam:
-                            targets_cam[t] = poses[frameIdxs[s]].world_frame_to_cam(targets[t])
-                        target = targets_cam[t]
-
-                        # get vectors from origin to target and to gaze point
-                        vGaze   = gaze  -ori
-                        vTarget = target-ori
-
-                    # get offset
-                    ang2D           = transforms.angle_between(vTarget,vGaze)
-                    # decompose in horizontal/vertical (in poster space)
-                    onPosterAngle   = math.atan2(gazePoster[1]-targets[t][1], gazePoster[0]-targets[t][0])
-                    offset[s,e,ti,:]= ang2D*np.array([math.cos(onPosterAngle), math.sin(onPosterAngle)])
+        # get camera pose w.r.t. poster for each sample. Samples for which there is no pose are not processed
+        frameIdxs        = gazeFrameIdxs[sel]
+        hasPose          = frameHasPose[frameIdxs-frameOff]
+        if not np.any(hasPose):
+            # nothing to compute for this interval
+            continue
+        Rt               = frameRt[frameIdxs-frameOff]
+
+        ts               = gazes['timestamp'][sel]
+        oriLeft          = gazes['gazeOriCamLeft'][sel]
+        oriRight         = gazes['gazeOriCamRight'][sel]
+        gaze3DLeft       = gazes['gazePosCamLeft'][sel]
+        gaze3DRight      = gazes['gazePosCamRight'][sel]
+        gaze2DLeft       = gazes['gazePosPlane2DLeft'][sel]
+        gaze2DRight      = gazes['gazePosPlane2DRight'][sel]
+        gaze3DWorld      = gazes['gazePosCamWorld'][sel]
+        gaze2DWorld      = gazes['gazePosPlane2DWorld'][sel]
+        gaze3DRay        = gazes['gazePosCam_vidPos_ray'][sel]
+        gaze2DRay        = gazes['gazePosPlane2D_vidPos_ray'][sel]
+        gaze3DHomography = gazes['gazePosCam_vidPos_homography'][sel]
+        gaze2DHomography = gazes['gazePosPlane2D_vidPos_homography'][sel]
+
+        # position of targets in camera space, for each sample (N x T x 3)
+        targets_cam = np.einsum('nij,tj->nti', Rt, targets_h)
+
+        offset = np.full((len(frameIdxs),len(dq_types),len(targets),2), np.nan)
+        zeros  = np.zeros((len(frameIdxs),3))
+        for e in range(len(dq_types)):
+            match dq_types[e]:
+                case DataQualityType.viewpos_vidpos_homography | DataQualityType.pose_vidpos_homography:
+                    # from camera perspective, using homography
+                    # pose_vidpos_homography   : using pose info
+                    # viewpos_vidpos_homography: using assumed viewing distance
+                    ori         = zeros
+                    gaze        = gaze3DHomography
+                    gazePoster  = gaze2DHomography
+                case DataQualityType.pose_vidpos_ray:
+                    # from camera perspective, using 3D gaze point ray
+                    ori         = zeros
+                    gaze        = gaze3DRay
+                    gazePoster  = gaze2DRay
+                case DataQualityType.pose_world_eye:
+                    # using 3D world gaze position, with respect to eye tracker reference frame's origin
+                    ori         = zeros
+                    gaze        = gaze3DWorld
+                    gazePoster  = gaze2DWorld
+                case DataQualityType.pose_left_eye:
+                    ori         = oriLeft
+                    gaze        = gaze3DLeft
+                    gazePoster  = gaze2DLeft
+                case DataQualityType.pose_right_eye:
+                    ori         = oriRight
+                    gaze        = gaze3DRight
+                    gazePoster  = gaze2DRight
+
+            # NB: samples with missing data yield NaN offsets, which are dropped below
+            if dq_types[e]==DataQualityType.viewpos_vidpos_homography:
+                # get vectors based on assumed viewing distance (from config), without using pose info
+                vGaze   = np.hstack((gazePoster, np.full((gazePoster.shape[0],1), distMm)))[:,None,:]
+                vTarget = targets_for_homo[None,:,:]
+            else:
+                # use 3D vectors known given pose information
+                # get vectors from origin to target and to gaze point
+                vGaze   = (gaze-ori)[:,None,:]
+                vTarget = targets_cam-ori[:,None,:]
+
+            # get offset (N x T)
+            ang2D           = utils.angle_between(vTarget,vGaze)
+            # decompose in horizontal/vertical (in poster space)
+            onPosterAngle   = np.arctan2(gazePoster[:,[1]]-targets_h[:,1], gazePoster[:,[0]]-targets_h[:,0])
+            offset[:,e,:,0] = ang2D*np.cos(onPosterAngle)
+            offset[:,e,:,1] = ang2D*np.sin(onPosterAngle)
+        offset[~hasPose] = np.nan
 
         # organize for output and write to file
-        # 1. create cartesian product of sample index, eye and target indices
-        # order of inputs needed to get expected output is a mystery to me, but screw it, works
-        dat = gt_utils.cartesian_product(np.arange(len(dq_types)),np.arange(offset.shape[0]),[t for t in targets])
+        # 1. get sample, data quality type and target index for each row of the flattened offset array
+        nSamp, nType, nTarget = offset.shape[:3]
+        sIdx = np.repeat(np.arange(nSamp), nType*nTarget)
+        eIdx = np.tile(np.repeat(np.arange(nType), nTarget), nSamp)
+        tIdx = np.tile(np.arange(nTarget), nSamp*nType)
+        offset = offset.reshape(-1,2)
         # 2. put into data frame
-        df                      = pd.DataFrame()
-        df['timestamp']         = ts[dat[:,1],0]
-        df['marker_interval']   = idx+1
-        df['type']              = [str(dq_types[e]) for e in dat[:,0]]
-        df['target']            = dat[:,2]
-        df                      = pd.concat([df, pd.DataFrame(np.reshape(offset,(-1,2)),columns=['offset_x','offset_y'])],axis=1)
+        df = pd.DataFrame({
+            'timestamp':        ts[sIdx],
+            'marker_interval':  idx+1,
+            'type':             pd.Categorical.from_codes(eIdx, categories=[str(e) for e in dq_types]),
+            'target':           targets[tIdx],
+            'offset_x':         offset[:,0],
+            'offset_y':         offset[:,1]})
         df                      = df.dropna(axis=0, subset=['offset_x','offset_y'])  # drop any missing data
         # 3. store for writing to file
         dfs.append(df)
 
     # all done, write to file (use polars as that library saves to file waaay faster)
-    df = pd.concat(dfs)
+    df = pd.concat(dfs) if dfs else pd.DataFrame(columns=['timestamp','marker_interval','type','target','offset_x','offset_y'])
     df = pl.from_pandas(df)
     df.write_csv(working_dir / output_gaze_offset_file_name, separator='\t', null_value='nan', float_precision=3)
 
     utils.update_recording_status(working_dir, utils.Task.Target_Offsets_Computed, utils.Status.Finished, skip_if_missing=True)
+
+
+def _rodrigues(rVecs: np.ndarray) -> np.ndarray:
+    # convert a set of rotation vectors (Nx3) to rotation matrices (Nx3x3) in one go using
+    # Rodrigues' formula: R = I + sin(theta)*K + (1-cos(theta))*K^2, with K the cross-product
+    # matrix of the unit rotation axis
+    theta   = np.linalg.norm(rVecs, axis=1)
+    u       = rVecs/np.where(theta>0, theta, 1.)[:,None]
+    K       = np.zeros((rVecs.shape[0],3,3))
+    K[:,0,1]= -u[:,2]
+    K[:,0,2]=  u[:,1]
+    K[:,1,0]=  u[:,2]
+    K[:,1,2]= -u[:,0]
+    K[:,2,0]= -u[:,1]
+    K[:,2,1]=  u[:,0]
+    theta   = theta[:,None,None]
+    return np.eye(3) + np.sin(theta)*K + (1-np.cos(theta))*(K@K)
@@ -3,6 +3,8 @@ import enum
 import json
 import csv
 
+import numpy as np
+
 from .makeVideo import process as make_video
 
 from glassesTools import utils
@@ -154,8 +156,28 @@ def writeMarkerIntervalsFile(fileName, intervals: list[int]|list[list[int]]):
     with open(fileName, 'w', newline='') as file:
         csv_writer = csv.writer(file, delimiter='\t')
         csv_writer.writerow(['start_frame', 'end_frame'])
-        for f in range(0,len(intervals)-1,2):   # -1 to make sure we don't write out incomplete intervals
-            csv_writer.writerow(intervals[f:f+2])
+        csv_writer.writerows(intervals[f:f+2] for f in range(0,len(intervals)-1,2))   # -1 to make sure we don't write out incomplete intervals
+
+
+def gaze_dict_to_arrays(gazes: dict[int,list], fields: list[str]) -> tuple[np.ndarray, dict[str,np.ndarray]]:
+    # flatten a dict of per-frame lists of gaze samples into one array per requested field,
+    # along with an array indicating for each sample which frame it belongs to. Samples are
+    # sorted by frame, so that the samples for a range of frames can be found with np.searchsorted
+    frames    = sorted(gazes)
+    n_samp    = sum(len(gazes[k]) for k in frames)
+    first     = next((s for k in frames for s in gazes[k]), None)
+    frame_idx = np.fromiter((k for k in frames for _ in gazes[k]), dtype='int', count=n_samp)
+    arrays    = {}
+    for f in fields:
+        # read directly into a preallocated array of the right shape, no intermediate lists
+        shape     = np.shape(getattr(first,f)) if first is not None else ()
+        arrays[f] = np.fromiter((getattr(s,f) for k in frames for s in gazes[k]), dtype=(float, shape), count=n_samp)
+    return frame_idx, arrays
+
+def angle_between(v1: np.ndarray, v2: np.ndarray) -> np.ndarray:
+    # angle (degrees) between vectors along the last axis, broadcasting over any other axes.
+    # atan2 of the cross and dot products remains accurate for (nearly) (anti-)parallel vectors
+    return np.degrees(np.arctan2(np.linalg.norm(np.cross(v1,v2),axis=-1), np.einsum('...i,...i',v1,v2)))
 
 
 
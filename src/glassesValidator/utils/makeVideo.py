@@ -1,6 +1,9 @@
 import shutil
 import os
+import sys
 import pathlib
+import queue
+import threading
 
 import cv2
 import numpy as np
@@ -65,6 +68,10 @@ def do_the_work(working_dir, config_dir, gui: video_player.GUI, show_rejected_ma
         # flatten
         analyzeFrames = [i for iv in analyzeFrames for i in iv]
     episodes = {annotation.Event.Validate: analyzeFrames}
+    # lookup table indicating for each frame whether it is in a validation interval
+    inInterval = np.zeros(max(analyzeFrames, default=-1)+1, dtype='bool')
+    for f in range(0,len(analyzeFrames)-1,2):   # -1 to make sure we don't announce incomplete intervals
+        inInterval[analyzeFrames[f]:analyzeFrames[f+1]+1] = True
 
     # Read gaze data
     gazes_head  = gaze_headref.read_dict_from_file(working_dir / naming.gaze_data_fname)[0]
@@ -77,7 +84,7 @@ def do_the_work(working_dir, config_dir, gui: video_player.GUI, show_rejected_ma
     video_ts = timestamps.VideoTimestamps(working_dir / naming.frame_timestamps_fname)
     pose_estimator = aruco.PoseEstimator(in_video, video_ts, cameraParams)
     pose_estimator.add_plane('validate',
-                             {'plane': poster, 'aruco_params': {'markerBorderBits': validationSetup['markerBorderBits']}, 'min_num_markers': validationSetup['minNumMarkers']})
+                             {'plane': poster, 'aruco_params': config.get_aruco_detector_params(validationSetup), 'min_num_markers': validationSetup['minNumMarkers']})
     pose_estimator.set_visualize_on_frame(True)
     pose_estimator.show_rejected_markers = show_rejected_markers
 
@@ -105,24 +112,45 @@ def do_the_work(working_dir, config_dir, gui: video_player.GUI, show_rejected_ma
         poster_win_id = gui.add_window('poster')
         gui.set_frame_size((ref_width, ref_height), poster_win_id)
 
-    should_exit = False
-    while True:
-        status, pose, _, _, (frame, frame_idx, frame_ts) = pose_estimator.process_one_frame()
-        # TODO: if there is a discontinuity, fill in the missing frames so audio stays in sync
-        # check if we're done
-        if status==aruco.Status.Finished:
-            break
-        # NB: no need to handle aruco.Status.Skip, since we didn't provide the pose estimator with any analysis intervals (we want to process the whole video)
-        pose = pose['validate']
+    # setup for frame annotation
+    font            = cv2.FONT_HERSHEY_PLAIN
+    fontScale       = 2
+    fontThickness   = 2
+    textPos         = (2, height-5)
+    textClr         = (0,255,255)   # yellow
+    intervalClr     = (0,0,255)     # red background for frames in a validation interval
+    otherClr        = (0,0,0)       # black background otherwise
+
+    # encoding is done on a separate thread, so that it overlaps with decoding and processing of the next frames
+    write_queue  = queue.Queue(maxsize=8)
+    writer       = propagating_thread.PropagatingThread(target=_write_frames, args=(write_queue, vidOutScene, vidOutPoster, (width, height), (ref_width, ref_height), fps), daemon=True)
+    writer.start()
+
+    # decoding and marker detection is done on a separate thread, so that it overlaps with drawing on the frames
+    read_queue  = queue.Queue(maxsize=4)
+    stop_reader = threading.Event()
+    reader      = propagating_thread.PropagatingThread(target=_read_frames, args=(pose_estimator, read_queue, stop_reader), daemon=True)
+    reader.start()
+
+    try:
+        should_exit = False
+        while True:
+            item = _queue_get(read_queue, reader)
+            # check if we're done
+            if item is None:
+                break
+            # TODO: if there is a discontinuity, fill in the missing frames so audio stays in sync
+            # NB: no need to handle aruco.Status.Skip, since we didn't provide the pose estimator with any analysis intervals (we want to process the whole video)
+            _, pose, _, _, (frame, frame_idx, frame_ts) = item
+            pose = pose['validate']
 
-        if frame is None:
-            # we don't have a valid frame, use a fully black frame
-            frame = np.zeros((height,width,3), np.uint8)   # black image
-        refImg = poster.get_ref_image(ref_width)
+            if frame is None:
+                # we don't have a valid frame, use a fully black frame
+                frame = np.zeros((height,width,3), np.uint8)   # black image
+            refImg = ref_img.copy()
 
-        # process gaze
-        if frame_idx in gazes_head:
-            for gaze in gazes_head[frame_idx]:
+            # process gaze
+            for gaze in gazes_head.get(frame_idx, []):
                 # draw gaze point on scene video
                 gaze.draw(frame, cameraParams, sub_pixel_fac)
 
@@ -132,38 +160,49 @@ def do_the_work(working_dir, config_dir, gui: video_player.GUI, show_rejected_ma
                 gazePoster.draw_on_world_video(frame, cameraParams, sub_pixel_fac)
                 gazePoster.draw_on_plane(refImg, poster, sub_pixel_fac)
 
-        # annotate frame
-        analysisIntervalIdx = None
-        for f in range(0,len(analyzeFrames)-1,2):   # -1 to make sure we don't announce incomplete intervals
-            if frame_idx>=analyzeFrames[f] and frame_idx<=analyzeFrames[f+1]:
-                analysisIntervalIdx = f
-        frameClr = (0,0,255) if analysisIntervalIdx is not None else (0,0,0)
+            # annotate frame
+            frameClr = intervalClr if frame_idx<inInterval.size and inInterval[frame_idx] else otherClr
 
-        text = '%6.3f [%6d] (%s markers)' % (frame_ts/1000.,frame_idx, pose.pose_N_markers)
-        textSize,baseline = cv2.getTextSize(text,cv2.FONT_HERSHEY_PLAIN,2,2)
-        cv2.rectangle(frame,(0,height),(textSize[0]+2,height-textSize[1]-baseline-5), frameClr, -1)
-        cv2.putText(frame, (text), (2, height-5), cv2.FONT_HERSHEY_PLAIN, 2, (0,255,255),2)
+            text = '%6.3f [%6d] (%s markers)' % (frame_ts/1000.,frame_idx, pose.pose_N_markers)
+            textSize,baseline = cv2.getTextSize(text,font,fontScale,fontThickness)
+            cv2.rectangle(frame,(0,height),(textSize[0]+2,height-textSize[1]-baseline-5), frameClr, -1)
+            cv2.putText(frame, (text), textPos, font, fontScale, textClr, fontThickness)
 
-        # store to file
-        img = Image(plane_buffers=[frame.flatten().tobytes()], pix_fmt='bgr24', size=(width, height))
-        vidOutScene.write_frame(img=img, pts=frame_idx/fps)
-        img = Image(plane_buffers=[refImg.flatten().tobytes()], pix_fmt='bgr24', size=(ref_width, ref_height))
-        vidOutPoster.write_frame(img=img, pts=frame_idx/fps)
+            # store to file
+            _queue_put(write_queue, (frame, refImg, frame_idx), writer)
 
-        if has_gui:
-            gui.update_image(frame , frame_ts/1000., frame_idx, window_id=gui.main_window_id)
-            gui.update_image(refImg, frame_ts/1000., frame_idx, window_id=poster_win_id)
+            if has_gui:
+                gui.update_image(frame , frame_ts/1000., frame_idx, window_id=gui.main_window_id)
+                gui.update_image(refImg, frame_ts/1000., frame_idx, window_id=poster_win_id)
 
-            requests = gui.get_requests()
-            for r,_ in requests:
-                if r=='exit':   # only request we need to handle
-                    should_exit = True
+                requests = gui.get_requests()
+                for r,_ in requests:
+                    if r=='exit':   # only request we need to handle
+                        should_exit = True
+                        break
+                if should_exit:
                     break
-            if should_exit:
-                break
+    finally:
+        # stop the threads and close the output files, also when exiting early or upon error.
+        # If we're already unwinding because of an error, don't let errors from the threads hide it
+        unwinding = sys.exc_info()[0] is not None
+        try:
+            # make sure reader stops
+            stop_reader.set()
+            try:
+                reader.join()
+            finally:
+                # let writer finish storing all queued frames and close the output files
+                try:
+                    _queue_put(write_queue, None, writer)
+                    writer.join()
+                finally:
+                    vidOutScene.close()
+                    vidOutPoster.close()
+        except Exception:
+            if not unwinding:
+                raise
 
-    vidOutScene.close()
-    vidOutPoster.close()
     if has_gui:
         gui.stop()
 
@@ -185,4 +224,54 @@ def do_the_work(working_dir, config_dir, gui: video_player.GUI, show_rejected_ma
             if f.exists():
                 tempName.unlink(missing_ok=True)
             else:
-                shutil.move(tempName, f)
\ No newline at end of file
+                shutil.move(tempName, f)
+
+def _read_frames(pose_estimator: aruco.PoseEstimator, read_queue: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        item = pose_estimator.process_one_frame()
+        if item[0]==aruco.Status.Finished:
+            break
+        _queue_put_until(read_queue, item, stop)
+    # None is the signal that all frames have been read
+    _queue_put_until(read_queue, None, stop)
+
+def _write_frames(write_queue: queue.Queue, vidOutScene: MediaWriter, vidOutPoster: MediaWriter, scene_size, poster_size, fps):
+    # None is the signal that all frames have been queued
+    while (item:=write_queue.get()) is not None:
+        frame, refImg, frame_idx = item
+        img = Image(plane_buffers=[frame.flatten().tobytes()], pix_fmt='bgr24', size=scene_size)
+        vidOutScene.write_frame(img=img, pts=frame_idx/fps)
+        img = Image(plane_buffers=[refImg.flatten().tobytes()], pix_fmt='bgr24', size=poster_size)
+        vidOutPoster.write_frame(img=img, pts=frame_idx/fps)
+
+def _queue_put(q: queue.Queue, item, consumer: propagating_thread.PropagatingThread):
+    # put with a timeout so we do not block forever on a full queue if the consumer thread
+    # died. If it did, join it to re-raise its error here
+    while True:
+        try:
+            q.put(item, timeout=.1)
+            return
+        except queue.Full:
+            if not consumer.is_alive():
+                consumer.join()
+                return
+
+def _queue_put_until(q: queue.Queue, item, stop: threading.Event):
+    # put with a timeout so we do not block forever on a full queue if the consumer stopped reading
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=.1)
+            return
+        except queue.Full:
+            pass
+
+def _queue_get(q: queue.Queue, producer: propagating_thread.PropagatingThread):
+    # get with a timeout so we do not block forever on an empty queue if the producer thread
+    # died. If it did, join it to re-raise its error here
+    while True:
+        try:
+            return q.get(timeout=.1)
+        except queue.Empty:
+            if not producer.is_alive():
+                producer.join()
+                return None
@@ -3,8 +3,9 @@ from pathlib import Path
 
 
 # Load the predefined dictionary
-dictionary = cv2.aruco.Dictionary_get(cv2.aruco.DICT_4X4_250)
+dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_4X4_250)
 
-board = cv2.aruco.CharucoBoard_create(7, 10, 4, 3, dictionary)
-imboard = board.draw((1414, 2000))
-cv2.imwrite(Path(__file__).resolve().parent / "chessboard1.png", imboard)
\ No newline at end of file
+board = cv2.aruco.CharucoBoard((7, 10), 4, 3, dictionary)
+board.setLegacyPattern(True)    # same layout as boards generated with older OpenCV versions (differs for an even number of rows)
+imboard = board.generateImage((1414, 2000))
+cv2.imwrite(str(Path(__file__).resolve().parent / "chessboard1.png"), imboard)